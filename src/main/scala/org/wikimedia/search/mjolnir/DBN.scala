@@ -115,23 +115,25 @@ class InputReader(minDocsPerQuery: Int, maxDocsPerQuery: Int, discardNoClicks: B
       val clicks = parseJsonBooleanArray(pieces(PIECE_CLICKS))
 
       makeSessionItem(query, region, urls, clicks)
-    }.toSeq
+    }
     // Guarantee we return a materialized collection and not a lazy one
-    // which wont have properly updated our max query/url ids
-    sessions.last
-    sessions
+    // which wont have properly updated our max query/url ids. An indexed
+    // collection also keeps random access in DbnModel.eStep constant time.
+    sessions.toVector
   }
 
-  def toRelevances(urlRelevances: Array[Array[UrlRel]]): Seq[RelevanceResult] = {
+  // Results are produced lazily so callers can stream them out without holding
+  // a second copy of every (query, url) pair in memory.
+  def toRelevances(urlRelevances: Array[Array[UrlRel]]): Iterator[RelevanceResult] = {
     val queryToUrlIdToUrl = queryIdToUrlToIdMap.map { case (queryId, urlToId) =>
       (queryId, urlToId.map(_.swap))
     }
     val queryIdToQuery = queryToIdMap.map(_.swap)
 
-    urlRelevances.zipWithIndex.flatMap { case (d, queryId) =>
+    urlRelevances.iterator.zipWithIndex.flatMap { case (d, queryId) =>
       val (query, region) = queryIdToQuery(queryId)
       val urlIdToUrl = queryToUrlIdToUrl(queryId)
-      d.zipWithIndex.view.map { case (urlRel, urlId) =>
+      d.iterator.zipWithIndex.map { case (urlRel, urlId) =>
         val url = urlIdToUrl(urlId)
         new RelevanceResult(query, region, url, urlRel.a * urlRel.s)
       }
@@ -460,8 +462,6 @@ class DbnModel(gamma: Double, config: Config) {
   }
 }
 
-private class DbnHitPage(val hitPageId: Int, val hitPosition: Double, val clicked: Boolean)
-
 /**
   * Predict relevance of query/page pairs from individual user search sessions.
   */
@@ -477,26 +477,32 @@ object DBN {
   private val SESSION_ID = "session_id"
   private val WIKI_ID = "wikiid"
 
+  // Field order of the hit structs collected by train
+  private val HIT_STRUCT_POSITION = 0
+  private val HIT_STRUCT_PAGE_ID = 1
+  private val HIT_STRUCT_CLICKED = 2
+
   /**
-    * Given a sequence of rows representing multiple searches
-    * for a single normalized query from a single session aggregate
-    * hits into their average position and tag if it was clicked or not
+    * Given a sequence of rows representing the deduplicated hits
+    * for a single normalized query from a single session, order
+    * them by their average position.
     *
-    * @param sessionHits Sequence of rows representing searches
-    *                    for a single normalized query and session.
+    * @param sessionHits Sequence of rows representing hits, with
+    *                    one row per page, for a single normalized
+    *                    query and session.
     * @return
     */
-  private def deduplicateHits(sessionHits: Seq[Row]): (Array[String], Array[Boolean]) = {
-    val deduped = sessionHits.groupBy(_.getAs[Int](HIT_PAGE_ID))
-      .map { case (hitPageId, hits) =>
-        val hitPositions = hits.map(_.getAs[Int](HIT_POSITION))
-        val clicked = hits.exists(_.getAs[Boolean](CLICKED))
-        val avgHitPosition = hitPositions.sum.toDouble / hitPositions.length.toDouble
-        new DbnHitPage(hitPageId, avgHitPosition, clicked)
-      }
-      .toSeq.sortBy(_.hitPosition)
-    val urls = deduped.map(_.hitPageId.toString).toArray
-    val clicked = deduped.map(_.clicked).toArray
+  private[mjolnir] def orderHits(sessionHits: Seq[Row]): (Array[String], Array[Boolean]) = {
+    val ordered = sessionHits.sortBy(_.getDouble(HIT_STRUCT_POSITION))
+    // Fill both outputs in one pass rather than building intermediate seqs
+    val urls = new Array[String](ordered.length)
+    val clicked = new Array[Boolean](ordered.length)
+    var i = 0
+    ordered.foreach { hit =>
+      urls(i) = hit.getInt(HIT_STRUCT_PAGE_ID).toString
+      clicked(i) = hit.getBoolean(HIT_STRUCT_CLICKED)
+      i += 1
+    }
     (urls, clicked)
   }
 
@@ -506,21 +512,70 @@ object DBN {
       T.StructField(HIT_PAGE_ID, T.IntegerType) ::
       T.StructField(RELEVANCE, T.DoubleType) :: Nil)
 
+  /**
+    * Collect hits into one row per wiki, normalized query and session,
+    * holding that session's hits deduplicated by page. Rows are
+    * partitioned by wiki and normalized query so each query is
+    * trained within a single partition.
+    *
+    * @param df Hits, one row per page per search
+    * @param numPartitions Number of partitions to group into, or None
+    *                      for spark.sql.shuffle.partitions
+    * @return
+    */
+  private[mjolnir] def groupSessions(df: DataFrame, numPartitions: Option[Int]): DataFrame = {
+    val dfHits = df
+      // Only carry the columns training needs, callers often pass wider
+      // dataframes such as cached session data with query strings.
+      .select(
+        F.col(WIKI_ID),
+        // norm query id comes from monotonicallyIncreasingId, and as such is 64bit
+        F.col(NORM_QUERY_ID).cast(T.LongType).alias(NORM_QUERY_ID),
+        F.col(SESSION_ID),
+        F.col(HIT_PAGE_ID).cast(T.IntegerType).alias(HIT_PAGE_ID),
+        F.col(HIT_POSITION).cast(T.IntegerType).alias(HIT_POSITION),
+        F.col(CLICKED))
+      // Hits without a key or position cannot be placed in a session ranking,
+      // and the struct readers in orderHits do not accept nulls.
+      .where(F.col(WIKI_ID).isNotNull &&
+        F.col(NORM_QUERY_ID).isNotNull &&
+        F.col(SESSION_ID).isNotNull &&
+        F.col(HIT_PAGE_ID).isNotNull &&
+        F.col(HIT_POSITION).isNotNull)
+      // Aggregate multiple searches for the same page within a session into
+      // their average position and whether any was clicked. Unlike collect_list
+      // these aggregates combine map side, so duplicate hits are reduced before
+      // they are shuffled.
+      .groupBy(WIKI_ID, NORM_QUERY_ID, SESSION_ID, HIT_PAGE_ID)
+      .agg(
+        F.avg(HIT_POSITION).alias(HIT_POSITION),
+        // A missing click flag counts as not clicked
+        F.coalesce(F.max(CLICKED), F.lit(false)).alias(CLICKED))
+
+    // Partitioning by query before collecting hits lets the session grouping
+    // below reuse this shuffle rather than adding its own.
+    val dfPartitioned = numPartitions match {
+      case Some(n) => dfHits.repartition(n, F.col(WIKI_ID), F.col(NORM_QUERY_ID))
+      case None => dfHits.repartition(F.col(WIKI_ID), F.col(NORM_QUERY_ID))
+    }
+
+    dfPartitioned
+      .groupBy(WIKI_ID, NORM_QUERY_ID, SESSION_ID)
+      // Field order must match the HIT_STRUCT_* indexes read by orderHits
+      .agg(F.collect_list(F.struct(HIT_POSITION, HIT_PAGE_ID, CLICKED)).alias(HITS))
+  }
+
   def train(df: DataFrame, dbnConfig: Map[String, String]): DataFrame = {
     val minDocsPerQuery = dbnConfig.getOrElse("MIN_DOCS_PER_QUERY", "10").toInt
     val maxDocsPerQuery = dbnConfig.getOrElse("MAX_DOCS_PER_QUERY", "10").toInt
     val defaultRel = dbnConfig.getOrElse("DEFAULT_REL", "0.9").toFloat
     val maxIterations = dbnConfig.getOrElse("MAX_ITERATIONS", "40").toInt
     val gamma = dbnConfig.getOrElse("GAMMA", "0.9").toFloat
+    // Each partition trains its queries serially, so this bounds how much of the
+    // cluster DBN can use. Defaults to spark.sql.shuffle.partitions.
+    val numPartitions = dbnConfig.get("NUM_PARTITIONS").map(_.toInt)
 
-    val dfGrouped = df
-      // norm query id comes from monotonicallyIncreasingId, and as such is 64bit
-      .withColumn(NORM_QUERY_ID, F.col(NORM_QUERY_ID).cast(T.LongType))
-      .withColumn(HIT_PAGE_ID, F.col(HIT_PAGE_ID).cast(T.IntegerType))
-      .withColumn(HIT_POSITION, F.col(HIT_POSITION).cast(T.IntegerType))
-      .groupBy(WIKI_ID, NORM_QUERY_ID, SESSION_ID)
-      .agg(F.collect_list(F.struct(HIT_POSITION, HIT_PAGE_ID, CLICKED)).alias(HITS))
-      .repartition(F.col(WIKI_ID), F.col(NORM_QUERY_ID))
+    val dfGrouped = groupSessions(df, numPartitions)
 
     val hitsIndex = dfGrouped.schema.fieldIndex(HITS)
     val normQueryIndex = dfGrouped.schema.fieldIndex(NORM_QUERY_ID)
@@ -529,24 +584,22 @@ object DBN {
     val rdd: RDD[Row] = dfGrouped
       .rdd.mapPartitions { rows: Iterator[Row] =>
       val reader = new InputReader(minDocsPerQuery, maxDocsPerQuery, discardNoClicks = true)
+      // Materialized, not a lazy Stream, so reader state is complete before config
       val items = rows.flatMap { row =>
         // Sorts lowest to highest
-        val (urls, clicked) = deduplicateHits(row.getSeq[Row](hitsIndex))
+        val (urls, clicked) = orderHits(row.getSeq[Row](hitsIndex))
         val query = row.getLong(normQueryIndex).toString
         val region = row.getString(wikiidIndex)
         reader.makeSessionItem(query, region, urls, clicked)
-      }.toSeq
+      }.toVector
       if (items.isEmpty) {
         Iterator()
       } else {
-        // When we get a lazy seq from the iterator ensure its materialized
-        // before creating config with the mutable state.
-        items.length
         val config = reader.config(defaultRel, maxIterations)
         val model = new DbnModel(gamma, config)
         reader.toRelevances(model.train(items)).map { rel =>
           new GenericRowWithSchema(Array(rel.region, rel.query.toLong, rel.url.toInt, rel.relevance), trainOutputSchema)
-        }.toIterator
+        }
       }
     }
 
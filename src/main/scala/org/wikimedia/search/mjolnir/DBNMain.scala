@@ -1,33 +1,136 @@
 package org.wikimedia.search.mjolnir
 
 import com.recipegrace.biglibrary.electric.{ElectricJob, ElectricSession}
+import org.apache.hadoop.fs.Path
+import org.apache.log4j.LogManager
+import org.apache.spark.sql.{DataFrame, Row, types => T}
+import org.apache.spark.storage.StorageLevel
 
 case class DBNInput(input:String, output:String)
 
 
 
 object DBNMain extends ElectricJob[DBNInput]{
-  override def execute(t: DBNInput)(implicit ec: ElectricSession): Unit = {
-
-
-
-    val sparkSession = ec.getSparkSession
+  // Declaring the input schema up front saves the full pass over the input
+  // that json schema inference would otherwise make, and lets the reader
+  // skip converting any fields the job does not use.
+  val inputSchema = T.StructType(
+    T.StructField("wikiid", T.StringType) ::
+      T.StructField("norm_query_id", T.LongType) ::
+      T.StructField("norm_query_str", T.StringType) ::
+      T.StructField("session_id", T.StringType) ::
+      T.StructField("hit_page_id", T.LongType) ::
+      T.StructField("hit_position", T.LongType) ::
+      T.StructField("clicked", T.BooleanType) :: Nil)
+
+  val outputSchema = T.StructType(
+    T.StructField("query", T.StringType) ::
+      T.StructField("omsId", T.IntegerType) ::
+      T.StructField("score", T.DoubleType) :: Nil)
+
+  private val log = LogManager.getLogger(getClass)
+
+  // Large inputs get one DBN training partition per this many bytes on disk,
+  // up to MAX_PARTITIONS
+  private val BYTES_PER_PARTITION = 32L * 1024 * 1024
+  private val MAX_PARTITIONS = 1000L
+
+  /**
+    * Spark's file readers skip anything whose name, at any depth below the
+    * input root, starts with _ or . such as _SUCCESS, _temporary and .crc files.
+    */
+  private def isDataFile(root: Path, file: Path): Boolean = {
+    var path = file
+    var visible = true
+    while (visible && path != null && path != root) {
+      visible = !(path.getName.startsWith("_") || path.getName.startsWith("."))
+      path = path.getParent
+    }
+    visible
+  }
 
-    val sessions = sparkSession.read.json(t.input)
+  /**
+    * Total size in bytes of the input files the reader would use. This is
+    * a filesystem metadata lookup, rather than a job counting rows.
+    */
+  private def inputSize(input: String)(implicit ec: ElectricSession): Long = {
+    val inputPath = new Path(input)
+    val fs = inputPath.getFileSystem(ec.getSparkSession.sparkContext.hadoopConfiguration)
+    Option(fs.globStatus(inputPath)).map(_.toSeq).getOrElse(Nil).map { status =>
+      val files = fs.listFiles(status.getPath, true)
+      var bytes = 0L
+      while (files.hasNext) {
+        val file = files.next()
+        if (isDataFile(status.getPath, file.getPath)) {
+          bytes += file.getLen
+        }
+      }
+      bytes
+    }.sum
+  }
 
+  /**
+    * Choose the number of DBN training partitions. Training is cpu bound per
+    * partition and bytes on disk understate compressed inputs, so the input
+    * size is only used to go above spark.sql.shuffle.partitions, never below.
+    */
+  private[mjolnir] def numTrainPartitions(inputBytes: Long, shufflePartitions: Int): Int = {
+    math.max(shufflePartitions.toLong, math.min(MAX_PARTITIONS, inputBytes / BYTES_PER_PARTITION)).toInt
+  }
 
-    val sessionsDF = sessions.select("norm_query_id","norm_query_str").distinct()
-    val urlRelevances = DBN.train(sessions, Map()).join(sessionsDF,"norm_query_id")
-      .select("norm_query_str","hit_page_id","relevance")
-        .withColumnRenamed("norm_query_str","query")
-        .withColumnRenamed("hit_page_id","omsId")
-        .withColumnRenamed("relevance","score")
+  private def writeOutput(df: DataFrame, output: String): Unit = {
+    // Keep the default ErrorIfExists mode. The output path comes from the
+    // caller, and a mistyped or parent path must not delete existing data.
+    df.write
+      .option("compression", "snappy")
+      .parquet(output)
+  }
 
+  override def execute(t: DBNInput)(implicit ec: ElectricSession): Unit = {
 
 
-    urlRelevances.show(10,false)
 
+    val sparkSession = ec.getSparkSession
 
+    // Resolving the reader fails fast when the input path does not exist.
+    // FAILFAST makes a record that does not fit inputSchema fail the job,
+    // rather than being read as all nulls and dropped before training.
+    val reader = sparkSession.read
+      .schema(inputSchema)
+      .option("mode", "FAILFAST")
+      .json(t.input)
+
+    // Inputs that exist but hold no data have nothing to train. Checking the
+    // files on disk avoids launching the DBN jobs only to find them empty.
+    val inputBytes = inputSize(t.input)
+    if (inputBytes == 0) {
+      log.warn(s"No data found in ${t.input}, writing empty output to ${t.output}")
+      // A single empty partition, rather than an empty rdd, so a parquet file
+      // carrying the schema is written and readers of the output still work.
+      val empty = sparkSession.sparkContext.parallelize(Seq.empty[Row], 1)
+      writeOutput(sparkSession.createDataFrame(empty, outputSchema), t.output)
+    } else {
+      // Sessions are consumed twice, once for the query string lookup and once
+      // by DBN training. Cache them so the input is only read and parsed once.
+      val sessions = reader.persist(StorageLevel.MEMORY_AND_DISK_SER)
+      try {
+        val sessionsDF = sessions.select("norm_query_id","norm_query_str").distinct()
+        val shufflePartitions = sparkSession.conf.get("spark.sql.shuffle.partitions").toInt
+        val dbnConfig = Map("NUM_PARTITIONS" -> numTrainPartitions(inputBytes, shufflePartitions).toString)
+        val urlRelevances = DBN.train(sessions, dbnConfig).join(sessionsDF,"norm_query_id")
+          .select("norm_query_str","hit_page_id","relevance")
+            .withColumnRenamed("norm_query_str","query")
+            .withColumnRenamed("hit_page_id","omsId")
+            .withColumnRenamed("relevance","score")
+
+        writeOutput(urlRelevances, t.output)
+
+        // Preview from the written output rather than recomputing DBN
+        sparkSession.read.parquet(t.output).show(10,false)
+      } finally {
+        sessions.unpersist()
+      }
+    }
 
   }
 }
@@ -1,10 +1,58 @@
 package org.wikimedia.search.mjolnir
 
+import java.io.File
+import java.nio.file.Files
+
 import com.recipegrace.biglibrary.electric.tests.ElectricJobTest
+import org.apache.hadoop.conf.Configuration
+import org.apache.hadoop.fs.Path
+import org.apache.parquet.hadoop.ParquetFileReader
+import org.apache.spark.sql.{types => T}
+
+import scala.collection.JavaConverters._
 
 class DBMainTest extends ElectricJobTest {
 
   test("dbn main") {
-    launch(DBNMain, DBNInput("/Users/sxr1pxy/Documents/spark-DBN/files/dbn_final_data.json", createTempPath()))
+    // DBNMain refuses to write over an existing path, so write below the temp path
+    launch(DBNMain, DBNInput("/Users/sxr1pxy/Documents/spark-DBN/files/dbn_final_data.json", createTempPath() + "/output"))
+  }
+
+  test("empty input writes an empty output with the output schema") {
+    // What spark leaves behind after writing an empty dataset on a checksummed
+    // filesystem: an empty part file, its non-empty .crc and a _SUCCESS marker.
+    val input = new File(createTempPath(), "input")
+    input.mkdirs()
+    Files.write(new File(input, "part-00000").toPath, Array[Byte]())
+    Files.write(new File(input, ".part-00000.crc").toPath, "crc".getBytes)
+    Files.write(new File(input, "_SUCCESS").toPath, Array[Byte]())
+    val output = new File(createTempPath(), "output")
+
+    launch(DBNMain, DBNInput(input.getPath, output.getPath))
+
+    val parts = output.listFiles().filter(_.getName.endsWith(".parquet"))
+    assert(parts.nonEmpty)
+    parts.foreach { part =>
+      val footer = ParquetFileReader.readFooter(new Configuration(), new Path(part.getPath))
+      assert(footer.getBlocks.asScala.map(_.getRowCount).sum === 0)
+      val sparkSchema = footer.getFileMetaData.getKeyValueMetaData.get("org.apache.spark.sql.parquet.row.metadata")
+      assert(T.DataType.fromJson(sparkSchema) === DBNMain.outputSchema)
+    }
+  }
+
+  test("train partitions never go below the shuffle partitions") {
+    assert(DBNMain.numTrainPartitions(0L, 200) === 200)
+    assert(DBNMain.numTrainPartitions(1024L * 1024 * 1024, 200) === 200)
+  }
+
+  test("train partitions grow with large inputs") {
+    // 10GB at 32MB per partition
+    assert(DBNMain.numTrainPartitions(10L * 1024 * 1024 * 1024, 200) === 320)
+  }
+
+  test("train partitions are capped for very large inputs") {
+    assert(DBNMain.numTrainPartitions(1024L * 1024 * 1024 * 1024, 200) === 1000)
+    // An operator configured shuffle partition count above the cap still wins
+    assert(DBNMain.numTrainPartitions(1024L * 1024 * 1024 * 1024, 2000) === 2000)
   }
 }
@@ -0,0 +1,46 @@
+package org.wikimedia.search.mjolnir
+
+import org.apache.spark.sql.{Row, SparkSession}
+import org.scalatest.{BeforeAndAfterAll, FunSuite}
+
+class DBNTest extends FunSuite with BeforeAndAfterAll {
+
+  private var spark: SparkSession = _
+
+  override def beforeAll(): Unit = {
+    spark = SparkSession.builder()
+      .master("local[1]")
+      .appName("DBNTest")
+      .getOrCreate()
+  }
+
+  override def afterAll(): Unit = {
+    spark.stop()
+  }
+
+  // A single session for one query in which page 10 was seen twice, at
+  // positions 0 and 4, and clicked only the second time. The last record
+  // is missing its page id, as a record that failed to parse would be.
+  private def sessionHits = spark.createDataFrame(Seq(
+    ("enwiki", 1L, "s1", Some(10L), 0L, false),
+    ("enwiki", 1L, "s1", Some(20L), 1L, false),
+    ("enwiki", 1L, "s1", Some(10L), 4L, true),
+    ("enwiki", 1L, "s1", Some(30L), 3L, false),
+    ("enwiki", 1L, "s1", None, 2L, true)
+  )).toDF("wikiid", "norm_query_id", "session_id", "hit_page_id", "hit_position", "clicked")
+
+  test("repeated hits are ordered by average position and clicked if any view was") {
+    val grouped = DBN.groupSessions(sessionHits, Some(1)).collect()
+    assert(grouped.length === 1)
+
+    val (urls, clicked) = DBN.orderHits(grouped.head.getAs[Seq[Row]]("hits"))
+    // page 10 averages position 2, between page 20 at 1 and page 30 at 3
+    assert(urls.toSeq === Seq("20", "10", "30"))
+    assert(clicked.toSeq === Seq(false, true, false))
+  }
+
+  test("train produces a relevance for each deduplicated page") {
+    val relevances = DBN.train(sessionHits, Map("MIN_DOCS_PER_QUERY" -> "1")).collect()
+    assert(relevances.map(_.getAs[Int]("hit_page_id")).sorted.toSeq === Seq(10, 20, 30))
+  }
+}